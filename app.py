@@ -1,71 +1,474 @@
 import streamlit as st
+import collections
+import contextlib
+import hashlib
+import io
 import json
 import os
-import re
+import tempfile
+import threading
 import uuid
 
+try:
+    import orjson
+except ImportError:  # Fall back to the (slower) standard library encoder
+    orjson = None
+
+try:
+    import zstandard as zstd
+except ImportError:  # Large histories stay uncompressed without it
+    zstd = None
+
 from agents.mitre_agent_refactored import MitreAttackAgent
 from agents.vuln_agent import VulnerabilityFixingAgent
 
 # --- Configuration ---
 HISTORY_DIR = "chat_history"
+VULN_HISTORY_DIR = os.path.join(HISTORY_DIR, "vuln")
 DEFAULT_THREAD_ID = "start-here"
 DEFAULT_USER_ID = "default-user"
+HISTORY_SUFFIX = ".jsonl"
+LEGACY_HISTORY_SUFFIX = ".json"
+COMPRESSED_HISTORY_SUFFIX = ".jsonl.zst"
+HISTORY_SUFFIXES = (COMPRESSED_HISTORY_SUFFIX, HISTORY_SUFFIX, LEGACY_HISTORY_SUFFIX)
+HISTORY_COMPRESS_THRESHOLD = 1024 * 1024  # JSONL size that triggers compression
+HISTORY_COMPRESS_KEEP_BYTES = HISTORY_COMPRESS_THRESHOLD // 2  # Recent JSONL kept
+HISTORY_ZSTD_LEVEL = 3
+HISTORY_TAIL_LENGTH = 100  # Messages kept in memory for display per thread
+HISTORY_TAIL_CHUNK_SIZE = 64 * 1024  # Bytes read per step when reading a tail
+HISTORY_CACHE_SIZE = 32  # Threads kept in memory, shared across all sessions
 
 # --- Ensure History Directory Exists ---
 os.makedirs(HISTORY_DIR, exist_ok=True)
+os.makedirs(VULN_HISTORY_DIR, exist_ok=True)
 
 # --- Helper Functions for History ---
 
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        """Serializes obj to compact JSON bytes."""
+        return orjson.dumps(obj)
+
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        """Serializes obj to compact JSON bytes."""
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Strips characters that are invalid in filenames and turns spaces into underscores
+_FILENAME_TRANS = str.maketrans({c: "" for c in '\\/*?:"<>|'} | {" ": "_"})
+
 
 def sanitize_filename(filename):
     """Removes potentially problematic characters for filenames."""
-    sanitized = re.sub(r'[\\/*?:"<>|]', "", filename)
-    sanitized = sanitized.replace(" ", "_")
+    sanitized = filename.translate(_FILENAME_TRANS)
     if not sanitized or sanitized.strip(".") == "":
-        return f"invalid_thread_{hash(filename)}"
+        # hash() of a str changes between processes; blake2b keeps the name stable
+        digest = hashlib.blake2b(filename.encode(), digest_size=8).hexdigest()
+        return f"invalid_thread_{digest}"
     return sanitized
 
 
-def get_history_filepath(thread_id):
-    """Constructs the full path for a thread's history file."""
-    return os.path.join(HISTORY_DIR, f"{sanitize_filename(thread_id)}.json")
+# Thread IDs whose history files were written during this script run
+_trusted_threads: set[str] = set()
 
 
-def load_chat_history(thread_id):
-    """Loads chat history from a JSON file for a given thread ID."""
-    filepath = get_history_filepath(thread_id)
-    if os.path.exists(filepath):
+def get_history_filepath(thread_id, suffix=HISTORY_SUFFIX):
+    """Constructs the full path for a thread's history file.
+
+    New histories are stored as JSONL (one message per line); pass
+    COMPRESSED_HISTORY_SUFFIX for the zstd-compressed older part of a large
+    history, or LEGACY_HISTORY_SUFFIX for an old single-document JSON file.
+    """
+    return os.path.join(HISTORY_DIR, f"{sanitize_filename(thread_id)}{suffix}")
+
+
+def _thread_id_from_filename(filename):
+    """Strips the history suffix from a history filename."""
+    for suffix in HISTORY_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[: -len(suffix)]
+    return filename
+
+
+def _iter_compressed_lines(filepath):
+    """Yields the JSONL lines of a zstd-compressed history file.
+
+    Corrupt or truncated data ends the stream with a warning; the lines decoded
+    from the frames before it are kept.
+    """
+    if zstd is None:
+        print(f"Warning: zstandard is required to read {filepath}. Skipping it.")
+        return
+    with open(filepath, "rb") as f:
+        reader = zstd.ZstdDecompressor().stream_reader(f, read_across_frames=True)
         try:
-            with open(filepath, "r") as f:
-                history = json.load(f)
-                if isinstance(history, list) and all(
-                    isinstance(msg, dict) and "role" in msg and "content" in msg
-                    for msg in history
-                ):
-                    return history
-                else:
-                    print(
-                        f"Warning: Invalid format found in {filepath}. Starting fresh."
-                    )
-                    return []
+            yield from io.BufferedReader(reader)
+        except zstd.ZstdError as e:
+            print(f"Warning: Stopped at corrupt data in {filepath}: {e}")
+
+
+def _read_tail_lines(filepath, n):
+    """Reads the last n lines of a file backwards in chunks."""
+    with open(filepath, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(HISTORY_TAIL_CHUNK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines()
+    if pos > 0:
+        lines = lines[1:]  # Drop the partial line at the start of the chunk
+    return lines[-n:]
+
+
+def _decode_lines(lines, filepath):
+    """Decodes JSONL lines, skipping (and reporting) any that are corrupt."""
+    history = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            history.append(_json_loads(line))
         except json.JSONDecodeError:
-            print(f"Warning: Could not decode JSON from {filepath}. Starting fresh.")
-            return []
-        except Exception as e:
-            print(f"Error loading history for thread '{thread_id}': {e}")
+            print(f"Warning: Skipping undecodable line in {filepath}.")
+    return history
+
+
+def load_chat_history(thread_id):
+    """Loads chat history for a given thread ID (JSONL, falling back to legacy JSON)."""
+    filepath = get_history_filepath(thread_id)
+    compressed_filepath = get_history_filepath(thread_id, COMPRESSED_HISTORY_SUFFIX)
+    legacy_filepath = get_history_filepath(thread_id, LEGACY_HISTORY_SUFFIX)
+    try:
+        if os.path.exists(filepath) or os.path.exists(compressed_filepath):
+            # Older messages (if any) are compressed; recent ones are plain JSONL
+            history = []
+            if os.path.exists(compressed_filepath):
+                history = _decode_lines(
+                    _iter_compressed_lines(compressed_filepath), compressed_filepath
+                )
+            if os.path.exists(filepath):
+                with open(filepath, "rb") as f:
+                    history += _decode_lines(f, filepath)
+        elif os.path.exists(legacy_filepath):
+            filepath = legacy_filepath
+            with open(filepath, "rb") as f:
+                history = _json_loads(f.read())
+        else:
             return []
+    except json.JSONDecodeError:
+        print(f"Warning: Could not decode JSON from {filepath}. Starting fresh.")
+        return []
+    except Exception as e:
+        print(f"Error loading history for thread '{thread_id}': {e}")
+        return []
+
+    if thread_id in _trusted_threads or _is_valid_history(history):
+        return history
+    print(f"Warning: Invalid format found in {filepath}. Starting fresh.")
+    return []
+
+
+def load_chat_tail(thread_id, n=HISTORY_TAIL_LENGTH):
+    """Loads only the last n messages of a thread's history.
+
+    Reads the JSONL file backwards in chunks so the cost is bounded by the
+    display window rather than by the length of the whole conversation.
+    """
+    filepath = get_history_filepath(thread_id)
+    compressed_filepath = get_history_filepath(thread_id, COMPRESSED_HISTORY_SUFFIX)
+    try:
+        if not (os.path.exists(filepath) or os.path.exists(compressed_filepath)):
+            return load_chat_history(thread_id)[-n:]
+        lines = _read_tail_lines(filepath, n) if os.path.exists(filepath) else []
+        if len(lines) < n and os.path.exists(compressed_filepath):
+            # Compression keeps recent messages in plain JSONL, so this is only
+            # reached for very long messages. zstd can't be read backwards, so
+            # stream it and keep what is needed.
+            older = collections.deque(
+                _iter_compressed_lines(compressed_filepath), maxlen=n - len(lines)
+            )
+            lines = [*older, *lines]
+        history = _decode_lines(lines, filepath)
+    except json.JSONDecodeError:
+        print(f"Warning: Could not decode JSON from {filepath}. Starting fresh.")
+        return []
+    except Exception as e:
+        print(f"Error loading history for thread '{thread_id}': {e}")
+        return []
+
+    if thread_id in _trusted_threads or _is_valid_history(history):
+        return history
+    print(f"Warning: Invalid format found in {filepath}. Starting fresh.")
     return []
 
 
-def save_chat_history(thread_id, messages):
-    """Saves chat history to a JSON file."""
+def _is_valid_message(msg):
+    return isinstance(msg, dict) and "role" in msg and "content" in msg
+
+
+def _is_valid_history(history):
+    """Checks that history is a list of chat message dicts.
+
+    Only the first and last messages are inspected: this app is the only writer
+    of history files, so a spot check is enough to reject foreign files.
+    """
+    if not isinstance(history, list):
+        return False
+    return not history or (
+        _is_valid_message(history[0]) and _is_valid_message(history[-1])
+    )
+
+
+def _migrate_legacy_history(thread_id):
+    """Converts a legacy JSON history file to JSONL so it can be appended to."""
+    legacy_filepath = get_history_filepath(thread_id, LEGACY_HISTORY_SUFFIX)
+    if not os.path.exists(legacy_filepath):
+        return
+    history = load_chat_history(thread_id)
+    with open(get_history_filepath(thread_id), "wb") as f:
+        f.writelines(_json_dumps(msg) + b"\n" for msg in history)
+    os.remove(legacy_filepath)
+
+
+def _replace_file(filepath, data):
+    """Writes data to filepath atomically via a uniquely named temporary file."""
+    fd, tmp_filepath = tempfile.mkstemp(
+        suffix=".tmp", dir=os.path.dirname(filepath) or "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filepath)
+        raise
+
+
+def _compress_history(thread_id):
+    """Moves the older part of a JSONL history into the thread's zstd file.
+
+    The older lines become one new frame at the end of the .jsonl.zst file. The
+    most recent lines (up to HISTORY_TAIL_LENGTH messages and
+    HISTORY_COMPRESS_KEEP_BYTES) stay in the JSONL file, so appends and tail
+    reads keep working on plain text. The frame is appended and synced before
+    the JSONL file is replaced atomically, so a crash can at worst duplicate
+    messages; a failed frame write is truncated away.
+    """
+    filepath = get_history_filepath(thread_id)
+    compressed_filepath = get_history_filepath(thread_id, COMPRESSED_HISTORY_SUFFIX)
+    with open(filepath, "rb") as f:
+        lines = f.readlines()
+
+    keep, kept_bytes = 0, 0
+    for line in reversed(lines):
+        if (
+            keep == HISTORY_TAIL_LENGTH
+            or kept_bytes + len(line) > HISTORY_COMPRESS_KEEP_BYTES
+        ):
+            break
+        keep += 1
+        kept_bytes += len(line)
+    older, recent = lines[: len(lines) - keep], lines[len(lines) - keep :]
+    if not older:
+        return
+
+    frame = zstd.ZstdCompressor(level=HISTORY_ZSTD_LEVEL).compress(b"".join(older))
+    with open(compressed_filepath, "ab") as f:
+        size = f.seek(0, os.SEEK_END)
+        try:
+            f.write(frame)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.truncate(size)  # Drop a partly written frame
+            raise
+    _replace_file(filepath, b"".join(recent))
+
+
+class _HistoryWriter:
+    """Appends messages to an already open JSONL history file."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def append(self, message):
+        self._f.write(_json_dumps(message) + b"\n")
+
+
+@st.cache_resource
+def _history_locks():
+    """Process-wide per-thread write locks and the lock guarding the dict."""
+    return {}, threading.Lock()
+
+
+def _history_lock(thread_id):
+    """Returns the lock serializing compaction and appends for a thread."""
+    locks, lock = _history_locks()
+    with lock:
+        return locks.setdefault(thread_id, threading.Lock())
+
+
+@contextlib.contextmanager
+def history_writer(thread_id):
+    """Opens a thread's history file once for a batch of appends.
+
+    The file is flushed and closed a single time when the block exits. Once the
+    JSONL file grows past HISTORY_COMPRESS_THRESHOLD its older part is moved
+    into the thread's zstd file first. The thread's write lock is held
+    throughout, so a compaction never rewrites the file under another
+    session's append.
+    """
     filepath = get_history_filepath(thread_id)
+    with _history_lock(thread_id):
+        try:
+            size = os.path.getsize(filepath)
+        except FileNotFoundError:
+            size = 0
+            compressed_filepath = get_history_filepath(
+                thread_id, COMPRESSED_HISTORY_SUFFIX
+            )
+            if not os.path.exists(compressed_filepath):
+                _migrate_legacy_history(thread_id)
+        if zstd is not None and size > HISTORY_COMPRESS_THRESHOLD:
+            _compress_history(thread_id)
+
+        # "a+b" lets the same handle check the last byte; writes still go to the end
+        with open(filepath, "a+b") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                f.seek(end - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # Terminate a torn line so it can't swallow ours
+            yield _HistoryWriter(f)
+    _trusted_threads.add(thread_id)
+
+
+def _flush_vuln_messages():
+    """Appends the vuln messages not yet on disk to this session's history file."""
+    messages = st.session_state.vuln_messages
+    filepath = os.path.join(
+        VULN_HISTORY_DIR, f"{st.session_state.vuln_session_id}{HISTORY_SUFFIX}"
+    )
     try:
-        with open(filepath, "w") as f:
-            json.dump(messages, f, indent=2)
+        with open(filepath, "ab") as f:
+            writer = _HistoryWriter(f)
+            for msg in messages[st.session_state.vuln_flushed :]:
+                writer.append(msg)
+        st.session_state.vuln_flushed = len(messages)
     except Exception as e:
-        print(f"Error saving history for thread '{thread_id}': {e}")
+        print(f"Error saving vulnerability chat history: {e}")
+
+
+@st.cache_data(show_spinner=False)
+def _list_history(mtime_ns):
+    """Lists history files, newest first.
+
+    Cached on the history directory's mtime so the directory is only rescanned
+    when files are added or removed. Appending to a file doesn't change that
+    mtime, so writers call _list_history.clear() to keep the order current.
+    """
+    # is_file() comes from the directory read; stat() is one syscall per entry
+    with os.scandir(HISTORY_DIR) as it:
+        entries = [e for e in it if e.is_file() and e.name.endswith(HISTORY_SUFFIXES)]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    return [e.name for e in entries]
+
+
+def _fence_marker(line):
+    """Returns the code fence run (``` or ~~~, possibly longer) a line starts with."""
+    stripped = line.lstrip()
+    for char in "`~":
+        if stripped.startswith(char * 3):
+            return stripped[: len(stripped) - len(stripped.lstrip(char))]
+    return None
+
+
+def _close_code_fences(text):
+    """Closes a code fence a message leaves open.
+
+    Past messages are joined into one Markdown document, so an unclosed fence
+    (a partial pasted snippet, a cut-off reply) would otherwise turn every later
+    message into code.
+    """
+    if "```" not in text and "~~~" not in text:
+        return text
+    open_fence = None
+    for line in text.splitlines():
+        marker = _fence_marker(line)
+        if marker is None:
+            continue
+        if open_fence is None:
+            open_fence = marker
+        elif (
+            marker[0] == open_fence[0]
+            and len(marker) >= len(open_fence)
+            and line.strip() == marker
+        ):
+            open_fence = None
+    return text if open_fence is None else f"{text}\n{open_fence}"
+
+
+def _history_markdown(thread_id, messages):
+    """Joins all but the latest message into a single Markdown string.
+
+    The result is memoized in session_state per (thread, list, message count), so
+    the join only runs again when a message has been added or the thread's list
+    was replaced (e.g. after it was cleared and reloaded).
+    """
+    key = (thread_id, id(messages), len(messages))
+    cached = st.session_state.get("history_markdown")
+    if cached is None or cached[0] != key:
+        markdown = "\n\n---\n\n".join(
+            f"**{msg['role'].capitalize()}:**\n\n{_close_code_fences(msg['content'])}"
+            for msg in messages[:-1]
+        )
+        cached = st.session_state.history_markdown = (key, markdown)
+    return cached[1]
+
+
+@st.cache_resource
+def _history_cache():
+    """Process-wide LRU of loaded thread histories and the lock guarding it."""
+    return collections.OrderedDict(), threading.Lock()
+
+
+def get_history(thread_id):
+    """Returns the in-memory message list for a thread, loading it on a miss."""
+    cache, lock = _history_cache()
+    with lock:
+        if thread_id in cache:
+            cache.move_to_end(thread_id)
+            return cache[thread_id]
+
+    # Read from disk without the lock so a slow load doesn't stall other sessions
+    print(f"Loading history for thread: {thread_id}")
+    history = load_chat_tail(thread_id)
+
+    with lock:
+        # Another session may have loaded the thread meanwhile; keep its list
+        history = cache.setdefault(thread_id, history)
+        cache.move_to_end(thread_id)
+        if len(cache) > HISTORY_CACHE_SIZE:
+            cache.popitem(last=False)
+        return history
+
+
+def evict_history(thread_id):
+    """Drops a thread from the in-memory history cache."""
+    cache, lock = _history_cache()
+    with lock:
+        cache.pop(thread_id, None)
 
 
 # --- Page Title ---
@@ -74,21 +477,26 @@ st.title("🛡️ Security Assistant")
 # --- Tab Selection ---
 tab1, tab2 = st.tabs(["MITRE ATT&CK Assistant", "Vulnerability Fixing"])
 
-# --- Initialize Agents ---
-if "mitre_agent" not in st.session_state:
-    try:
-        st.session_state.mitre_agent = MitreAttackAgent()
-        # st.success("MITRE Agent initialized.") # Less verbose success message
-    except Exception as e:
-        st.error(f"Failed to initialize MITRE Agent: {e}")
-        st.stop()
 
-if "vuln_agent" not in st.session_state:
-    st.session_state.vuln_agent = VulnerabilityFixingAgent()
+# --- Initialize Agents (Once per process, shared by all sessions) ---
+@st.cache_resource(show_spinner="Loading MITRE Agent...")
+def _get_mitre_agent():
+    return MitreAttackAgent()
+
+
+@st.cache_resource(show_spinner="Loading Vulnerability Agent...")
+def _get_vuln_agent():
+    return VulnerabilityFixingAgent()
+
+
+try:
+    mitre_agent = _get_mitre_agent()
+except Exception as e:
+    st.error(f"Failed to initialize MITRE Agent: {e}")
+    st.stop()
+
+vuln_agent = _get_vuln_agent()
 
-# --- Initialize Chat Histories Structure (Once per session) ---
-if "chat_histories" not in st.session_state:
-    st.session_state.chat_histories = {}
 
 # --- Initialize current_thread_id if not set ---
 if "current_thread_id" not in st.session_state:
@@ -103,7 +511,8 @@ with st.sidebar:
         new_thread_id = f"chat_{uuid.uuid4()}"  # Generate unique ID
         st.session_state.current_thread_id = new_thread_id
         # Ensure history entry exists for the new thread (will be empty)
-        st.session_state.chat_histories[new_thread_id] = []
+        get_history(new_thread_id)
+        _list_history.clear()
         # No need to save empty history here, load will handle it
         st.success(f"Started new chat: {new_thread_id}")
         # Rerun to reflect the new thread ID in the input box and clear chat area
@@ -114,28 +523,39 @@ with st.sidebar:
 
     # List existing chat history files
     try:
-        history_files = [f for f in os.listdir(HISTORY_DIR) if f.endswith(".json")]
-        # Sort files, maybe newest first? (Optional: based on modification time)
-        # history_files.sort(key=lambda f: os.path.getmtime(os.path.join(HISTORY_DIR, f)), reverse=True)
+        history_files = _list_history(os.stat(HISTORY_DIR).st_mtime_ns)
 
         if not history_files:
             st.caption("No past conversations found.")
         else:
-            # Display button for each history file
-            for filename in history_files:
-                thread_id_from_file = filename[:-5]  # Remove .json extension
-                # Use a more user-friendly display name if possible, here just using the ID
-                display_name = thread_id_from_file
-                # Make button slightly smaller or style differently if needed
-                if st.button(
-                    display_name,
-                    key=f"history_{thread_id_from_file}",
-                    use_container_width=True,
-                ):
-                    if st.session_state.current_thread_id != thread_id_from_file:
-                        st.session_state.current_thread_id = thread_id_from_file
-                        # No need to explicitly load here, the main logic below handles it
-                        st.rerun()  # Rerun to load the selected chat
+            # A single radio instead of one button per file keeps the widget count
+            # constant no matter how many conversations exist
+            # A large thread has both a .jsonl and a .jsonl.zst file
+            history_thread_ids = list(
+                dict.fromkeys(
+                    _thread_id_from_filename(filename) for filename in history_files
+                )
+            )
+            current_thread_id = st.session_state.current_thread_id
+            selected_thread_id = st.radio(
+                "Past Conversations",
+                options=history_thread_ids,
+                index=(
+                    history_thread_ids.index(current_thread_id)
+                    if current_thread_id in history_thread_ids
+                    else None
+                ),
+                # Remount only when the thread changes elsewhere (e.g. New Chat)
+                key=f"history_{current_thread_id}",
+                label_visibility="collapsed",
+            )
+            if (
+                selected_thread_id is not None
+                and selected_thread_id != current_thread_id
+            ):
+                st.session_state.current_thread_id = selected_thread_id
+                # No need to explicitly load here, the main logic below handles it
+                st.rerun()  # Rerun to load the selected chat
 
     except FileNotFoundError:
         st.error(f"History directory not found: {HISTORY_DIR}")
@@ -159,45 +579,53 @@ with st.sidebar:
     # Optional: Button to clear current thread history
     if st.button("🗑️ Clear Current Thread History"):
         active_thread_id_on_clear = st.session_state.current_thread_id
-        # Also delete the file
-        filepath_to_delete = get_history_filepath(active_thread_id_on_clear)
-        if active_thread_id_on_clear in st.session_state.chat_histories:
-            del st.session_state.chat_histories[
-                active_thread_id_on_clear
-            ]  # Remove from session state cache
-        if os.path.exists(filepath_to_delete):
-            try:
-                os.remove(filepath_to_delete)
-                st.success(
-                    f"History for thread '{active_thread_id_on_clear}' cleared and file deleted."
-                )
-                # Switch to default thread or a new one after deleting
-                st.session_state.current_thread_id = DEFAULT_THREAD_ID
-                st.rerun()
-            except Exception as e:
-                st.error(f"Could not delete history file {filepath_to_delete}: {e}")
+        # Also delete the files (a large thread has a .jsonl and a .jsonl.zst)
+        filepaths_to_delete = [
+            filepath
+            for filepath in (
+                get_history_filepath(active_thread_id_on_clear, suffix)
+                for suffix in HISTORY_SUFFIXES
+            )
+            if os.path.exists(filepath)
+        ]
+        delete_error = None
+        try:
+            for filepath in filepaths_to_delete:
+                os.remove(filepath)
+        except Exception as e:
+            delete_error = e
+        # Evict only once the files are gone, so a concurrent load in another
+        # session can't put the deleted messages back into the shared cache
+        evict_history(active_thread_id_on_clear)  # Remove from in-memory cache
+        st.session_state.pop("history_markdown", None)
+        if delete_error is not None:
+            st.error(f"Could not delete history file {filepath}: {delete_error}")
+        elif filepaths_to_delete:
+            _list_history.clear()
+            st.success(
+                f"History for thread '{active_thread_id_on_clear}' cleared and file deleted."
+            )
+            # Switch to default thread or a new one after deleting
+            st.session_state.current_thread_id = DEFAULT_THREAD_ID
+            st.rerun()
         else:
             st.warning(
                 f"History file for '{active_thread_id_on_clear}' not found for deletion."
             )
-            # Still clear from session state if it exists there
-            if active_thread_id_on_clear in st.session_state.chat_histories:
-                del st.session_state.chat_histories[active_thread_id_on_clear]
             st.session_state.current_thread_id = DEFAULT_THREAD_ID  # Reset to default
             st.rerun()
 
-# --- Load History for the Current Thread ---
+# --- Current Thread ---
 active_thread_id = st.session_state.current_thread_id
-if active_thread_id not in st.session_state.chat_histories:
-    print(f"Loading history for thread: {active_thread_id}")
-    st.session_state.chat_histories[active_thread_id] = load_chat_history(
-        active_thread_id
-    )
 
-current_messages = st.session_state.chat_histories.get(active_thread_id, [])
 
 # --- MITRE ATT&CK Tab ---
-with tab1:
+# Each tab is a fragment, so interacting with one tab reruns only that tab
+@st.fragment
+def mitre_tab(active_thread_id):
+    # Load history for the current thread
+    current_messages = get_history(active_thread_id)
+
     # Header inside the tab
     st.header(f"MITRE ATT&CK Assistant")
     st.caption(f"Conversation Thread: `{active_thread_id}`")
@@ -206,11 +634,15 @@ with tab1:
 
     # Display existing messages within the container
     with message_container:
+        empty_state = st.empty()
         if not current_messages:
-            st.info("Start the conversation by typing below.")
-        for msg in current_messages:
-            with st.chat_message(msg["role"]):
-                st.markdown(msg["content"])
+            empty_state.info("Start the conversation by typing below.")
+        else:
+            # Past messages render as one element; only the latest gets a bubble
+            if len(current_messages) > 1:
+                st.markdown(_history_markdown(active_thread_id, current_messages))
+            with st.chat_message(current_messages[-1]["role"]):
+                st.markdown(current_messages[-1]["content"])
 
     # Chat input: Positioned after the message container in the code flow
     mitre_prompt = st.chat_input(
@@ -220,12 +652,13 @@ with tab1:
 
     # --- Handle Input ---
     if mitre_prompt:
-        # 1. Append and save user message
+        # 1. Append user message (saved together with the reply below)
         user_message = {"role": "user", "content": mitre_prompt}
         current_messages.append(user_message)
-        save_chat_history(active_thread_id, current_messages)
 
-        # 2. *Immediately* display user message in the container
+        # 2. *Immediately* display user message in the container. This is the
+        # only time it is drawn for this run, so drop the empty-thread hint
+        empty_state.empty()
         with message_container:
             with st.chat_message("user"):
                 st.markdown(mitre_prompt)
@@ -235,38 +668,50 @@ with tab1:
         with message_container:
             with st.chat_message("assistant"):
                 with st.spinner("Thinking..."):
-                    if "mitre_agent" in st.session_state:
-                        try:
-                            response = st.session_state.mitre_agent.invoke(
-                                mitre_prompt,
-                                thread_id=active_thread_id,
-                                user_id=DEFAULT_USER_ID,
-                            )
-                            print(
-                                f"Agent response for thread '{active_thread_id}': {response[:100]}..."
-                            )
-                            assistant_message_content = (
-                                response if response else "*No response generated.*"
-                            )
-
-                        except Exception as e:
-                            st.error(f"An error occurred: {e}")
-                            print(f"Agent invocation error: {e}")
-                            assistant_message_content = f"Sorry, an error occurred: {e}"
-                    else:
-                        st.error("MITRE Agent is not initialized.")
-                        assistant_message_content = "Agent not available."
-
-        # 4. Append and save assistant message *after* it's generated and displayed
-        assistant_message = {"role": "assistant", "content": assistant_message_content}
+                    try:
+                        response = mitre_agent.invoke(
+                            mitre_prompt,
+                            thread_id=active_thread_id,
+                            user_id=DEFAULT_USER_ID,
+                        )
+                        print(
+                            f"Agent response for thread '{active_thread_id}': {response[:100]}..."
+                        )
+                        assistant_message_content = (
+                            response if response else "*No response generated.*"
+                        )
+
+                    except Exception as e:
+                        st.error(f"An error occurred: {e}")
+                        print(f"Agent invocation error: {e}")
+                        assistant_message_content = f"Sorry, an error occurred: {e}"
+                st.markdown(assistant_message_content)
+
+        # 4. Append assistant message *after* it's generated and displayed, then
+        # save the whole turn with one open/flush/close. Agent errors are caught
+        # above, so the user message is saved even when the agent fails.
+        assistant_message = {
+            "role": "assistant",
+            "content": assistant_message_content,
+        }
         current_messages.append(assistant_message)
-        save_chat_history(active_thread_id, current_messages)
+        try:
+            with history_writer(active_thread_id) as history:
+                history.append(user_message)
+                history.append(assistant_message)
+        except Exception as e:
+            print(f"Error saving history for thread '{active_thread_id}': {e}")
+        _list_history.clear()  # This thread is now the most recently modified
 
-        st.rerun()  # Rerun to refresh the chat display
+        # The turn is already rendered above, so only rerun when this turn created
+        # the history file and the sidebar needs to list the new conversation
+        if len(current_messages) == 2:
+            st.rerun()
 
 
 # --- Vulnerability Fixing Tab ---
-with tab2:
+@st.fragment
+def vuln_tab(active_thread_id):
     st.header("Vulnerability Fixing Assistant")
     st.markdown(
         """
@@ -278,6 +723,8 @@ with tab2:
     # --- Chat History State for Vuln Fixing ---
     if "vuln_messages" not in st.session_state:
         st.session_state.vuln_messages = []
+        st.session_state.vuln_session_id = f"vuln_{uuid.uuid4()}"
+        st.session_state.vuln_flushed = 0  # Messages already written to disk
 
     # --- Display Message History ---
     for msg in st.session_state.vuln_messages:
@@ -298,7 +745,7 @@ with tab2:
         with st.chat_message("assistant"):
             with st.spinner("Analyzing..."):
                 # Use active_thread_id and DEFAULT_USER_ID defined earlier
-                response = st.session_state.vuln_agent.invoke(
+                response = vuln_agent.invoke(
                     vuln_prompt, thread_id=active_thread_id, user_id=DEFAULT_USER_ID
                 )
 
@@ -316,3 +763,14 @@ with tab2:
                     )
                 else:
                     st.markdown("*⚠️ No analysis response was returned.*")
+
+        # Persist the turn's messages (and any left over from a failed turn) in
+        # one append
+        _flush_vuln_messages()
+
+
+with tab1:
+    mitre_tab(active_thread_id)
+
+with tab2:
+    vuln_tab(active_thread_id)